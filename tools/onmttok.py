@@ -35,6 +35,11 @@ class onmttok():
         tokens, _ = self.tokenizer.tokenize(text)
         return tokens
 
+    def tokenize_batch(self, lines):
+        ### tokenizes a list of strings in one C++ call (no per-line python/C++ crossing)
+        tokens_batch, _ = self.tokenizer.tokenize_batch(lines)
+        return tokens_batch
+
     def detokenize(self, tokens):
         return self.tokenizer.detokenize(tokens)
 
@@ -59,14 +59,31 @@ spacer_annotate: True
 
     tokenizer = onmttok(tok_config, bpe_model=bpe_model, sp_model=sp_model)
     tic = time.time()
-    for l in sys.stdin:
-        l = l.rstrip()
-        if detok:
+    if detok:
+        for l in sys.stdin:
             #print('detok:',l.split())
-            print(tokenizer.detokenize(l.split()))
-        else:
-            #print('tok:',tokenizer.tokenize(l))
-            print(' '.join(tokenizer.tokenize(l)))
+            print(tokenizer.detokenize(l.rstrip().split()))
+    else:
+        ### read stdin by 16MB chunks and split on newlines: no per-line file-iterator call, one C++ crossing per chunk
+        buf = sys.stdin.buffer
+        out = sys.stdout.buffer
+        CHUNK = 1 << 24
+        tail = b''
+        while True:
+            data = buf.read(CHUNK)
+            if not data:
+                break
+            data = tail + data
+            nl = data.rfind(b'\n')
+            if nl == -1: ### no complete line yet
+                tail = data
+                continue
+            tail = data[nl+1:] ### partial trailing line, kept for the next chunk
+            tokens_batch = tokenizer.tokenize_batch(data[:nl].decode('utf-8').split('\n'))
+            out.write(('\n'.join(' '.join(t) for t in tokens_batch) + '\n').encode('utf-8'))
+        if tail: ### last line had no trailing newline
+            tokens_batch = tokenizer.tokenize_batch([tail.decode('utf-8')])
+            out.write(('\n'.join(' '.join(t) for t in tokens_batch) + '\n').encode('utf-8'))
     toc = time.time()
     sys.stderr.write('Done ({:.2f} seconds)\n'.format(toc-tic))
 
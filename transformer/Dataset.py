@@ -2,17 +2,34 @@
 
 import sys
 import os
+import json
+import mmap
+import hashlib
 import logging
-import codecs
+import weakref
 import numpy as np
-from collections import defaultdict
-from tools.Tools import flatten_count
+import torch
+from multiprocessing import shared_memory
+
+CACHE_MIN_BYTES = 1 << 20 ### corpora smaller than this re-encode fast; caching them would only grow ~/.cache/minmt
+
+
+def release_shms(shms, unlink=True):
+  ### close shared memory blocks; the creating process also unlinks them
+  for shm in shms:
+    shm.close()
+    if unlink:
+      try:
+        shm.unlink()
+      except FileNotFoundError:
+        pass ### already unlinked by the creating process
 
 #######################################################
 ### Vocab #############################################
 #######################################################
 class Vocab():
   def __init__(self, fvoc):
+    self.fvoc = fvoc
     self.idx_pad = 0
     self.str_pad = '<pad>'
     self.idx_unk = 1
@@ -25,11 +42,13 @@ class Vocab():
 #    self.str_sep = '⸨sep⸩'
 #    self.idx_msk = 5
 #    self.str_msk = '⸨msk⸩'
-    self.tok_to_idx = defaultdict()
     self.idx_to_tok = []
-    with codecs.open(fvoc, 'r', 'utf-8') as fd:
-      self.idx_to_tok = [l for l in fd.read().splitlines()]
-    self.tok_to_idx = {k:i for i,k in enumerate(self.idx_to_tok)}
+    self.tok_to_idx = {}
+    with open(fvoc, 'r', encoding='utf-8') as fd: ### single pass over the file, no intermediate list of lines
+      for i, l in enumerate(fd):
+        tok = sys.intern(l.rstrip('\n')) ### interned keys let dict lookups hit the pointer-compare fast path
+        self.idx_to_tok.append(tok)
+        self.tok_to_idx[tok] = i
     assert self.tok_to_idx[self.str_pad] == 0, '<pad> must exist in vocab with id=0 while found id={}'.format(self.tok_to_idx[self.str_pad])
     assert self.tok_to_idx[self.str_unk] == 1, '<unk> must exist in vocab with id=1 while found id={}'.format(self.tok_to_idx[self.str_unk])
     assert self.tok_to_idx[self.str_bos] == 2, '<bos> must exist in vocab with id=2 while found id={}'.format(self.tok_to_idx[self.str_bos])
@@ -42,39 +61,54 @@ class Vocab():
     return len(self.idx_to_tok)
 
   def __contains__(self, s): ### implementation of the method used when invoking : entry in vocab
-    if type(s) == int:
+    if isinstance(s, (int, np.integer)):
       return s < len(self.idx_to_tok) ### testing an Idx
     return s in self.tok_to_idx ### testing a string
 
   def __getitem__(self, s): ### implementation of the method used when invoking : vocab[entry]
-    if type(s) == int: ### return a string
+    if isinstance(s, (int, np.integer)): ### return a string
       return self.idx_to_tok[s]
     if s in self.tok_to_idx: ### return an index
       return self.tok_to_idx[s]
     else:
       return self.idx_unk
 
+  def encode(self, tokens): ### encodes a list of tokens into a np.int32 array (no per-token __getitem__ dispatch)
+    d = self.tok_to_idx
+    unk = self.idx_unk
+    return np.fromiter((d.get(t, unk) for t in tokens), dtype=np.int32, count=len(tokens))
+
+  def decode(self, idxs): ### decodes a sequence of indices into a list of tokens (no per-index __getitem__ dispatch)
+    i2t = self.idx_to_tok
+    return [i2t[i] for i in idxs]
+
 
 ##############################################################################################################
 ### Batch ####################################################################################################
 ##############################################################################################################
 class Batch():
+  ### reusable container: allocated once, reset() between flushes (no per-batch object/list churn)
   def __init__(self, batch_size, batch_type, n_files=2):
     super(Batch, self).__init__()
     self.batch_size = batch_size
     self.batch_type = batch_type
     self.n_files = n_files
-    self.idxs_pos = [] ### list of pos (referred to positions of the original dataset) contained in this batch
-    self.max_lens = [0] * n_files
+    self.Pos = np.empty(batch_size, dtype=np.int64) ### preallocated positions buffer (a batch never holds more than batch_size examples)
+    self.max_len = 0 ### running max length over all files/examples held (the padded cost driver)
+    self.n = 0 ### number of examples currently held
+
+  def reset(self):
+    self.n = 0
+    self.max_len = 0
 
   def fits(self, lens):
     ### returns True if a new example with lengths (lsrc, ltgt) can be added in this batch; False otherwise
+    ### every file shares the example count, so the per-file budget checks collapse to one on the max length
     if self.batch_type == 'tokens':
-      for n in range(self.n_files):
-        if max(lens[n],self.max_lens[n]) * (len(self.idxs_pos)+1) > self.batch_size:
-          return False
+      if max(self.max_len, max(lens)) * (self.n+1) > self.batch_size:
+        return False
     elif self.batch_type == 'sentences':
-      if len(self.idxs_pos) == self.batch_size:
+      if self.n == self.batch_size:
         return False
     else:
       logging.error('Bad -batch_type option')
@@ -82,12 +116,16 @@ class Batch():
     return True
 
   def add(self, pos, lens):
-    self.idxs_pos.append(pos)
-    for n in range(self.n_files):
-      self.max_lens[n] = max(lens[n],self.max_lens[n])
+    self.Pos[self.n] = pos
+    self.n += 1
+    self.max_len = max(self.max_len, max(lens))
+
+  def idxs_pos(self):
+    ### copy of the positions held so far (the internal buffer is reused after reset())
+    return self.Pos[:self.n].copy()
 
   def __len__(self):
-    return len(self.idxs_pos)
+    return self.n
 
 
 ##############################################################################################################
@@ -105,93 +143,228 @@ class Dataset():
     self.idx_unk = vocs[0].idx_unk
     self.idx_bos = vocs[0].idx_bos
     self.idx_eos = vocs[0].idx_eos
-    self.Idxs = []
+    self.Ids = []  ### one contiguous np.int32 array per file (all sentences concatenated)
+    self.Offs = [] ### one np.int64 offsets array per file: sentence pos is Ids[Offs[pos]:Offs[pos+1]]
+    self.shms = [] ### shared_memory blocks backing Ids/Offs (call close() to release them)
     self.files = files
 
     for n in range(len(files)):
       if not os.path.isfile(files[n]):
         logging.error('Cannot read file {}'.format(files[n]))
         sys.exit()
-      with codecs.open(files[n], 'r', 'utf-8') as fd:
-        idxs = [[vocs[n][t] for t in l.split()] for l in fd.read().splitlines()]
-      self.Idxs.append(idxs)
-      ### compute tokens and OOVs
-      n_tok, n_unk = flatten_count(self.Idxs[-1], [self.idx_unk])
-      logging.info('Read Corpus ({} lines ~ {} tokens ~ {} OOVs [{:.2f}%]) from {}'.format(len(idxs),n_tok,n_unk,100.0*n_unk/n_tok,files[n]))
-      assert len(self.Idxs[0]) == len(self.Idxs[-1]), 'Non-parallel corpus in dataset'
+
+    ### pre-scan: count tokens per line with C-level bytes ops and drop long examples before wasting encode work on them
+    self.keep = None
+    if self.max_length:
+      for n in range(len(files)):
+        cnts = self.count_tokens(files[n])
+        assert self.keep is None or len(cnts) == len(self.keep), 'Non-parallel corpus in dataset'
+        self.keep = (cnts <= self.max_length) if self.keep is None else (self.keep & (cnts <= self.max_length))
+      n_drop = int((~self.keep).sum())
+      if n_drop == len(self.keep):
+        logging.error('All {} examples filtered out by max_length={}'.format(n_drop, self.max_length))
+        sys.exit()
+      if n_drop:
+        logging.info('Filtered {} examples longer than {} tokens'.format(n_drop, self.max_length))
+
+    for n in range(len(files)):
+      ids, offs = self.encode_file_cached(files[n], vocs[n])
+      self.Ids.append(self.to_shared(ids))
+      self.Offs.append(self.to_shared(offs))
+      ### compute tokens and OOVs (not counting the baked-in bos/eos)
+      n_tok = len(ids) - 2*(len(offs)-1)
+      n_unk = int((ids == self.idx_unk).sum())
+      logging.info('Read Corpus ({} lines ~ {} tokens ~ {} OOVs [{:.2f}%]) from {}'.format(len(offs)-1,n_tok,n_unk,100.0*n_unk/n_tok if n_tok else 0.0,files[n]))
+      assert len(self.Offs[0]) == len(self.Offs[-1]), 'Non-parallel corpus in dataset'
+
+    ### precompute lengths: Lens[n,pos] is the length (incl. bos/eos) of sentence pos in file n
+    self.Lens = np.stack([np.diff(offs).astype(np.int32) for offs in self.Offs])
+    self.MaxLen = self.Lens.max(axis=0) ### max length over files, per sentence
+    self.finalizer = weakref.finalize(self, release_shms, self.shms) ### releases the shm blocks at gc/exit even if close() is never called
+
+  def count_tokens(self, fpath):
+    ### upper-bound token count per line (spaces+1 on raw bytes, no decode/split)
+    with open(fpath, 'rb') as fd:
+      mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+      cnts = np.fromiter((line.count(b' ')+1 for line in iter(mm.readline, b'')), dtype=np.int32)
+      mm.close()
+    return cnts
+
+  def encode_file_cached(self, fpath, voc):
+    ### reuse the encoded corpus from ~/.cache/minmt when fpath, the vocab and the length filter are unchanged
+    mask = hashlib.sha1(self.keep.tobytes()).hexdigest() if self.keep is not None else 'nofilter'
+    key = '{}:{}:{}:{}:{}:{}'.format(os.path.abspath(fpath), os.stat(fpath).st_mtime_ns, os.path.getsize(fpath), os.path.abspath(voc.fvoc), os.stat(voc.fvoc).st_mtime_ns, mask)
+    cdir = os.path.join(os.path.expanduser('~'), '.cache', 'minmt')
+    cpath = os.path.join(cdir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+    if os.path.isfile(cpath + '.ids.npy') and os.path.isfile(cpath + '.offs.npy'):
+      ids = np.load(cpath + '.ids.npy', mmap_mode='r') ### no parsing, pages shared with other processes
+      offs = np.load(cpath + '.offs.npy', mmap_mode='r')
+      logging.info('Reused cached corpus {} for {}'.format(cpath, fpath))
+      return ids, offs
+    ids, offs = self.encode_file(fpath, voc)
+    if os.path.getsize(fpath) < CACHE_MIN_BYTES:
+      return ids, offs ### keeps every small test/valid set out of the cache
+    os.makedirs(cdir, exist_ok=True)
+    for suffix, arr in (('.ids.npy', ids), ('.offs.npy', offs)):
+      tmp = '{}.{}{}'.format(cpath, os.getpid(), suffix) ### write-then-rename so concurrent runs never load a truncated file
+      np.save(tmp, arr)
+      os.rename(tmp, cpath + suffix)
+    logging.info('Cached corpus {} for {}'.format(cpath, fpath))
+    return ids, offs
+
+  def encode_file(self, fpath, voc):
+    ### parse the mmap'd raw bytes of fpath against a bytes-keyed vocab: no per-line utf-8 decode, no str per token
+    ### bos/eos are baked in here once so __iter__ yields plain zero-copy views (no per-yield concatenation)
+    d = {k.encode('utf-8'): v for k, v in voc.tok_to_idx.items()}
+    unk = voc.idx_unk
+    keep = self.keep
+    arrs = []
+    with open(fpath, 'rb') as fd:
+      mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+      for i, line in enumerate(iter(mm.readline, b'')):
+        if keep is not None and not keep[i]: ### filtered by max_length during the pre-scan
+          continue
+        toks = line.split()
+        arr = np.empty(len(toks)+2, dtype=np.int32)
+        arr[0] = voc.idx_bos
+        arr[-1] = voc.idx_eos
+        arr[1:-1] = np.fromiter((d.get(t, unk) for t in toks), dtype=np.int32, count=len(toks))
+        arrs.append(arr)
+      mm.close()
+    lens = np.fromiter((len(a) for a in arrs), dtype=np.int64, count=len(arrs))
+    ids = np.concatenate(arrs) if len(arrs) else np.empty(0, dtype=np.int32)
+    offs = np.concatenate(([0], np.cumsum(lens)))
+    return ids, offs
+
+  def seq(self, n, pos):
+    ### zero-copy view of sentence pos in file n
+    return self.Ids[n][self.Offs[n][pos]:self.Offs[n][pos+1]]
+
+  def to_shared(self, arr):
+    ### move arr into a shared_memory block so DataLoader workers attach to the same pages instead of copying
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    shared[:] = arr
+    self.shms.append(shm)
+    return shared
+
+  def __getstate__(self):
+    ### pickle shm names/shapes/dtypes rather than the corpus arrays (workers reattach in __setstate__)
+    state = self.__dict__.copy()
+    state.pop('finalizer', None) ### not picklable; __setstate__ registers its own
+    state['Ids'] = [(a.shape, a.dtype.str) for a in self.Ids]
+    state['Offs'] = [(a.shape, a.dtype.str) for a in self.Offs]
+    state['shms'] = [shm.name for shm in self.shms]
+    return state
+
+  def __setstate__(self, state):
+    names = state.pop('shms')
+    Ids = state.pop('Ids')
+    Offs = state.pop('Offs')
+    self.__dict__.update(state)
+    self.shms = [shared_memory.SharedMemory(name=name) for name in names]
+    self.Ids = [np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.shms[2*n].buf) for n,(shape,dtype) in enumerate(Ids)]
+    self.Offs = [np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.shms[2*n+1].buf) for n,(shape,dtype) in enumerate(Offs)]
+    self.finalizer = weakref.finalize(self, release_shms, self.shms, False) ### attached processes close but never unlink
+
+  def save(self, ddir):
+    ### persist the encoded corpus as .npy files (one pickle opcode per array, not per int)
+    os.makedirs(ddir, exist_ok=True)
+    for n in range(len(self.Ids)):
+      np.save(os.path.join(ddir, 'ids_{}.npy'.format(n)), self.Ids[n])
+      np.save(os.path.join(ddir, 'offs_{}.npy'.format(n)), self.Offs[n])
+    meta = {'files': self.files, 'n_files': len(self.Ids), 'shard_size': self.shard_size, 'batch_size': self.batch_size, 'batch_type': self.batch_type, 'max_length': self.max_length, 'idx_pad': self.idx_pad, 'idx_unk': self.idx_unk, 'idx_bos': self.idx_bos, 'idx_eos': self.idx_eos}
+    with open(os.path.join(ddir, 'meta.json'), 'w') as fd:
+      json.dump(meta, fd)
+    logging.info('Saved Dataset ({} files) into {}'.format(len(self.Ids), ddir))
+
+  @classmethod
+  def load(cls, ddir):
+    ### rebuild a Dataset written by save(); corpus arrays are mmap'd, never re-parsed nor materialized
+    with open(os.path.join(ddir, 'meta.json'), 'r') as fd:
+      meta = json.load(fd)
+    self = cls.__new__(cls)
+    self.files = meta['files']
+    self.shard_size = meta['shard_size']
+    self.batch_size = meta['batch_size']
+    self.batch_type = meta['batch_type']
+    self.max_length = meta['max_length']
+    self.idx_pad = meta['idx_pad']
+    self.idx_unk = meta['idx_unk']
+    self.idx_bos = meta['idx_bos']
+    self.idx_eos = meta['idx_eos']
+    self.shms = []
+    self.Ids = [np.load(os.path.join(ddir, 'ids_{}.npy'.format(n)), mmap_mode='r') for n in range(meta['n_files'])]
+    self.Offs = [np.load(os.path.join(ddir, 'offs_{}.npy'.format(n)), mmap_mode='r') for n in range(meta['n_files'])]
+    self.Lens = np.stack([np.diff(offs).astype(np.int32) for offs in self.Offs])
+    self.MaxLen = self.Lens.max(axis=0)
+    self.finalizer = weakref.finalize(self, release_shms, self.shms) ### no shm blocks here, keeps close() uniform
+    logging.info('Loaded Dataset ({} files ~ {} lines) from {}'.format(len(self.Ids), len(self), ddir))
+    return self
+
+  def close(self):
+    ### release the shared memory blocks now (the finalizer is idempotent and also runs at gc/exit)
+    self.Ids = []
+    self.Offs = []
+    self.finalizer()
+    self.shms = []
 
 
   def build_batchs(self, lens, idxs_pos, n_files):
     assert len(lens) == len(idxs_pos)
-    ord_lens = np.argsort(lens) #sort by lens (lower to higher lenghts)
-    idxs_pos = np.asarray(idxs_pos)
-    idxs_pos = idxs_pos[ord_lens]
+    ord_lens = np.argsort(lens, kind='stable') #sort by lens (lower to higher lenghts); stable selects radix sort on int32 lengths (O(N) on the small length domain) and keeps the shuffle order within equal lengths
+    idxs_pos = np.asarray(idxs_pos)[ord_lens]
+    n_pos = len(idxs_pos)
 
     batchs = []
-    b = Batch(self.batch_size, self.batch_type, n_files) #empty batch
-    for pos in idxs_pos:
-      lens = self.lens(pos,add=2)
-
-      if not b.fits(lens): ### cannot add in current batch b
-        if len(b):
-          batchs.append(b.idxs_pos) ### save batch
-          b = Batch(self.batch_size, self.batch_type, n_files) #new empty batch
-
-      if b.fits(lens):
-        ### add current example
-        b.add(pos,lens)
-      else:
-        ### discard current example
-        logging.warning('Example {} does not fit in empty batch [Discarded] ~ {}:{}'.format(pos,self.ftxt_src,self.ftxt_tgt))
-
-    if len(b): 
-      ### save last batch
-      batchs.append(b.idxs_pos)
+    if self.batch_type == 'sentences':
+      batchs = [idxs_pos[i:i+self.batch_size] for i in range(0, n_pos, self.batch_size)]
 
-    logging.info('Built {} batchs in shard'.format(len(batchs)))
-    return batchs
+    elif self.batch_type == 'tokens':
+      ### greedy-pack the sorted shard: since examples come sorted by length, the padded cost of
+      ### batching examples [start, start+k) is max(L[start:start+k]) * k, nondecreasing in k
+      L = self.Lens[:, idxs_pos].max(axis=0) #length per example (all files, incl. bos/eos)
+      start = 0
+      while start < n_pos:
+        stop = min(n_pos, start + self.batch_size) #a batch never holds more than batch_size examples
+        cost = np.maximum.accumulate(L[start:stop]) * np.arange(1, stop-start+1)
+        k = np.searchsorted(cost, self.batch_size, side='right')
+        if k == 0:
+          ### discard current example
+          logging.warning('Example {} does not fit in empty batch [Discarded]'.format(idxs_pos[start]))
+          start += 1
+          continue
+        batchs.append(idxs_pos[start:start+k])
+        start += k
 
-  def lens(self, pos, add=2):
-    l = []
-    for n in range(len(self.Idxs)):
-      l.append(len(self.Idxs[n][pos]) + add)
-    return l
+    else:
+      logging.error('Bad -batch_type option')
+      sys.exit()
 
-  def filter_length(self, pos):
-    if self.max_length == 0:
-      return False
-    for n in range(len(self.Idxs)):
-      if len(self.Idxs[n][pos]) > self.max_length:
-        return True
-    return False
+    logging.info('Built {} batchs in shard'.format(len(batchs)))
+    return batchs
 
   def __len__(self):
-    return len(self.Idxs[0])
+    return len(self.Offs[0]) - 1
 
   def __iter__(self):
-    assert len(self.Idxs) > 0, 'Empty dataset'
-    n_files = len(self.Idxs)
-    n_lines = len(self.Idxs[0])
+    assert len(self.Ids) > 0, 'Empty dataset'
+    n_files = len(self.Ids)
+    n_lines = len(self)
     ### randomize all data ###
-    idxs_pos = [i for i in range(n_lines)]
+    idxs_pos = np.arange(n_lines)
     np.random.shuffle(idxs_pos)
     logging.debug('Shuffled Dataset ({} examples)'.format(n_lines))
     ### split dataset in shards ###
-    self.shard_size = self.shard_size or len(self.Idxs[0])
+    self.shard_size = self.shard_size or n_lines
     shards = [idxs_pos[i:i+self.shard_size] for i in range(0, n_lines, self.shard_size)]
     ### traverse shards ###
-    for s,shard in enumerate(shards): #each shard is a list of positions in the original corpus self.Idxs
+    for s,shard in enumerate(shards): #each shard is a list of positions in the original corpus self.Ids
       ###################
       ### build shard ###
       ###################
-      shard_len = []
-      shard_pos = []
-      for pos in shard:
-        if not self.filter_length(pos):
-          shard_pos.append(pos)
-          shard_len.append(len(self.Idxs[0][pos]))
-          if len(shard_pos) == self.shard_size:
-            break
+      shard_pos = np.asarray(shard) ### max_length filtering already happened at load time
+      shard_len = self.Lens[0, shard_pos]
       logging.info('Built shard {}/{} ({} examples)'.format(s+1,len(shards),len(shard_pos)))
       ####################
       ### build batchs ###
@@ -200,20 +373,39 @@ class Dataset():
       ####################
       ### yield batchs ###
       ####################
-      idx_batchs = [i for i in range(len(batchs))]
-      np.random.shuffle(idx_batchs)
+      idx_batchs = np.random.permutation(len(batchs))
       logging.debug('Shuffled {} batchs'.format(len(idx_batchs)))
+      pin = torch.cuda.is_available() ### pinned host memory enables async (non_blocking) H2D copies
       for i in idx_batchs:
-        batch_pos = batchs[i]
-        batch_idx = [] #idxs_all[0] => source batch, idxs_all[1] => target batch, ...
+        batch_pos = batchs[i] #np.int64 array of positions in the original corpus
+        #batch_idx[0] => source batch, batch_idx[1] => target batch, ... each a padded LongTensor [bs, max_len] (bos/eos already baked in)
+        batch_idx = []
         for n in range(n_files):
-          idxs = []
-          for pos in batch_pos:
-            idxs.append([self.idx_bos] + self.Idxs[n][pos] + [self.idx_eos])
-          batch_idx.append(idxs)
+          ids = self.Ids[n]
+          offs = self.Offs[n]
+          arr = np.full((len(batch_pos), int(self.Lens[n, batch_pos].max())), self.idx_pad, dtype=np.int64)
+          for r, p in enumerate(batch_pos):
+            seq = ids[offs[p]:offs[p+1]]
+            arr[r, :len(seq)] = seq
+          t = torch.from_numpy(arr)
+          batch_idx.append(t.pin_memory() if pin else t)
         yield batch_pos, batch_idx
 
 
+if __name__ == '__main__':
+  ### encode a parallel corpus once and persist it; later runs Dataset.load() it in milliseconds (mmap'd)
+  from tools.Tools import create_logger
+  if len(sys.argv) != 6:
+    sys.stderr.write('usage: {} src_voc tgt_voc src_file tgt_file odir\n'.format(sys.argv[0]))
+    sys.exit()
+  create_logger(None, 'info')
+  data = Dataset([Vocab(sys.argv[1]), Vocab(sys.argv[2])], [sys.argv[3], sys.argv[4]])
+  data.save(sys.argv[5])
+  data.close()
+  data = Dataset.load(sys.argv[5])
+  logging.info('Reloaded Dataset ({} examples)'.format(len(data)))
+
+
 
 
 
@@ -102,7 +102,7 @@ class Inference():
         for b in range(len(finals)):
           for n, (hyp, logp) in enumerate(sorted(finals[b].items(), key=lambda kv: kv[1], reverse=True)):
             hyp = list(map(int,hyp.split(' ')))
-            out, hyp = self.format_hyp(pos[b],n,logp,hyp,batch_idxs[0][b])
+            out, hyp = self.format_hyp(pos[b],n,logp,hyp,batch_idxs[0][b].tolist())
             dhyps[pos[b]-1] = hyp
             fh.write(out + '\n')
             fh.flush()
@@ -282,7 +282,7 @@ class Inference():
     logP_bs_k = logP.view(bs,self.K,lt)
     for b in range(hyps_bs_k.shape[0]):
       for k in range(hyps_bs_k.shape[1]):
-        logging.info('batch {} beam {}\tlogP={:.6f}\t{}'.format(b, k, sum(logP_bs_k[b,k]), ' '.join([self.tgt_voc[t] for t in hyps_bs_k[b,k].tolist()]) ))
+        logging.info('batch {} beam {}\tlogP={:.6f}\t{}'.format(b, k, sum(logP_bs_k[b,k]), ' '.join(self.tgt_voc.decode(hyps_bs_k[b,k].tolist())) ))
 
 
   def format_hyp(self, p, n, c, tgt_idx, src_idx): 
@@ -295,7 +295,7 @@ class Inference():
       src_idx = src_idx[:-1]
 
     hyp = []
-    hyp.append(' '.join([self.tgt_voc[idx] for idx in tgt_idx[1:-1]])) ### output sentence (tokenized)
+    hyp.append(' '.join(self.tgt_voc.decode(tgt_idx[1:-1]))) ### output sentence (tokenized)
 
     out = []
     for ch in self.format:
@@ -309,14 +309,14 @@ class Inference():
       ### input sentence ###
       ######################
       elif ch=='s':
-        out.append(' '.join([self.src_voc[idx] for idx in src_idx[1:-1]])) ### input sentence (tokenized)
+        out.append(' '.join(self.src_voc.decode(src_idx[1:-1]))) ### input sentence (tokenized)
       elif ch=='j':
         out.append(' '.join(map(str,src_idx))) ### input sentence (idxs)
       #########################
       ### target hypothesis ###
       #########################
       elif ch=='t':
-        out.append(' '.join([self.tgt_voc[idx] for idx in tgt_idx[1:-1]])) ### output sentence (tokenized)
+        out.append(' '.join(self.tgt_voc.decode(tgt_idx[1:-1]))) ### output sentence (tokenized)
       elif ch=='i':
         out.append(' '.join(map(str,tgt_idx))) ### output sentence (idxs)
 
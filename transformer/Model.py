@@ -71,22 +71,32 @@ def load_model(suffix, model, device, fmodel=None):
   return step, model
 
 def prepare_source(batch_src, idx_pad, device):
-  src = [torch.tensor(seq) for seq in batch_src] #[bs, ls]
-  src = torch.nn.utils.rnn.pad_sequence(src, batch_first=True, padding_value=idx_pad).to(device) #[bs,ls]
+  if not torch.is_tensor(batch_src): ### list of sequences (Dataset yields pre-padded pinned tensors, pad here for other callers)
+    batch_src = torch.nn.utils.rnn.pad_sequence([torch.tensor(seq) for seq in batch_src], batch_first=True, padding_value=idx_pad) #[bs,ls]
+  src = batch_src.to(device, non_blocking=True) #[bs,ls] (async H2D when batch_src is pinned)
   msk_src = (src != idx_pad).unsqueeze(-2) #[bs,1,ls] (False where <pad> True otherwise)
   return src, msk_src
 
 def prepare_prefix(batch_pre, idx_pad, device):
-  pre = [torch.tensor(seq) for seq in batch_pre] #[bs, lp]
-  pre = torch.nn.utils.rnn.pad_sequence(pre, batch_first=True, padding_value=idx_pad).to(device) #[bs,lp]
+  if not torch.is_tensor(batch_pre):
+    batch_pre = torch.nn.utils.rnn.pad_sequence([torch.tensor(seq) for seq in batch_pre], batch_first=True, padding_value=idx_pad) #[bs,lp]
+  pre = batch_pre.to(device, non_blocking=True) #[bs,lp]
   msk_pre = (pre != idx_pad).unsqueeze(-2) #[bs,1,ls] (False where <pad> True otherwise)
   return pre, msk_pre
 
 def prepare_target(batch_tgt, idx_pad, device):
-  tgt = [torch.tensor(seq[:-1]) for seq in batch_tgt] #delete <eos>
-  tgt = torch.nn.utils.rnn.pad_sequence(tgt, batch_first=True, padding_value=idx_pad).to(device) 
-  ref = [torch.tensor(seq[1:])  for seq in batch_tgt] #delete <bos> 
-  ref = torch.nn.utils.rnn.pad_sequence(ref, batch_first=True, padding_value=idx_pad).to(device)
+  if not torch.is_tensor(batch_tgt):
+    tgt = [torch.tensor(seq[:-1]) for seq in batch_tgt] #delete <eos>
+    tgt = torch.nn.utils.rnn.pad_sequence(tgt, batch_first=True, padding_value=idx_pad).to(device)
+    ref = [torch.tensor(seq[1:])  for seq in batch_tgt] #delete <bos>
+    ref = torch.nn.utils.rnn.pad_sequence(ref, batch_first=True, padding_value=idx_pad).to(device)
+  else:
+    batch_tgt = batch_tgt.to(device, non_blocking=True) #[bs,lt+1]
+    lens = (batch_tgt != idx_pad).sum(dim=1) #[bs] true length of each sequence (incl. bos/eos)
+    tgt = batch_tgt[:, :-1].clone() #delete <eos> of the longest row...
+    short = lens < batch_tgt.size(1)
+    tgt[short, lens[short]-1] = idx_pad #...and of every shorter row (their <eos> survived the column slice)
+    ref = batch_tgt[:, 1:] #delete <bos>
   msk_tgt = (tgt != idx_pad).unsqueeze(-2) & (1 - torch.triu(torch.ones((1, tgt.size(1), tgt.size(1)), device=tgt.device), diagonal=1)).bool() #[bs,lt,lt]
   return tgt, ref, msk_tgt
 